@@ -1,21 +1,24 @@
 import asyncio
-import json
+import msgpack
+import orjson
 import re
 import os
 import datetime
 import traceback
 import time
 from collections import defaultdict
-from tkinter import W
-from tokenize import String
-from typing import Dict, List, TypedDict
+from typing import Dict, List, Optional, Tuple, TypedDict
 from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
 from requests.structures import CaseInsensitiveDict
 from scrapfly import ScrapeApiResponse, ScrapeConfig, ScrapflyClient
 from dotenv import load_dotenv
 from pprint import pprint
-from pandas import *
+import pandas as pd
 from threading import Thread
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
 
 
 start_time = 0
@@ -61,19 +64,82 @@ def start_status():
 def stop_status():
     status_active = False
 
-def create_search_page_url(
+
+# Page parsing is pure CPU work that holds the GIL, so it is handed off to worker
+# processes and runs on all cores while the event loop keeps downloading pages.
+_PARSE_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+
+class LimitedSession:
+    """wraps a ScrapflyClient so that at most `max_concurrency` requests are in flight,
+    however many searches, hotels and review pages are scraped at the same time"""
+
+    def __init__(self, client: ScrapflyClient):
+        self.client = client
+        self.max_concurrency = client.max_concurrency
+        self.slots = asyncio.Semaphore(client.max_concurrency)
+
+    async def async_scrape(self, scrape_config: ScrapeConfig) -> ScrapeApiResponse:
+        async with self.slots:
+            return await self.client.async_scrape(scrape_config)
+
+    async def concurrent_scrape(self, scrape_configs: List[ScrapeConfig]):
+        """yield results in the order they complete, raising on the first failed request"""
+        for config in scrape_configs:
+            # like ScrapflyClient.concurrent_scrape, an error status from the target
+            # site still comes back as a response instead of raising
+            config.raise_on_upstream_error = False
+        tasks = [asyncio.ensure_future(self.async_scrape(config)) for config in scrape_configs]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+# Selectors used by the parse_* functions are compiled once at import and reused
+# for every page, instead of being translated and compiled again on each call.
+_css_translator = HTMLTranslator()
+_HTML_PARSER = etree.HTMLParser(recover=True, encoding="utf-8", huge_tree=True)
+
+
+# regexes for values embedded in page HTML and inline javascript
+_RE_PROPS_FOUND = re.compile(r"([\d,]+) properties found")
+_RE_TOKENS = re.compile(r"b_(hotel_id|csrf_token|aid|sid):\s*'([^']+)'")
+
+
+def _parse_html(html: str) -> etree._Element:
+    """parse page HTML straight into an lxml tree, skipping parsel's Selector wrappers"""
+    # same clean up and fallbacks as parsel, so empty pages give an empty tree
+    body = html.strip().replace("\x00", "").encode("utf-8") or b"<html/>"
+    root = etree.fromstring(body, parser=_HTML_PARSER)
+    if root is None:
+        root = etree.fromstring(b"<html/>", parser=_HTML_PARSER)
+    return root
+
+
+def _compile_css(css: str) -> etree.XPath:
+    """compile a parsel style css selector (supports ::text and ::attr()) to a reusable XPath"""
+    return etree.XPath(_css_translator.css_to_xpath(css), smart_strings=False)
+
+
+def _first(xpath: etree.XPath, node, default=""):
+    """return first match of a compiled selector, like parsel's `.get(default)`"""
+    found = xpath(node)
+    return found[0] if found else default
+
+def create_search_query(
     query,
     checkin: str = "",
     checkout: str = "",
     number_of_rooms=1,
-    offset: int = 0,
-):
-    """scrapes a single hotel search page of booking.com"""
+) -> str:
+    """creates the url query of a hotel search, shared by all of its result pages"""
     checkin_year, checking_month, checking_day = checkin.split("-") if checkin else "", "", ""
     checkout_year, checkout_month, checkout_day = checkout.split("-") if checkout else "", "", ""
 
-    url = "https://www.booking.com/searchresults.html"
-    url += "?" + urlencode(
+    return urlencode(
         {
             "ss": query,
             "checkin_year": checkin_year,
@@ -83,17 +149,22 @@ def create_search_page_url(
             "checkout_month": checkout_month,
             "checkout_monthday": checkout_day,
             "no_rooms": number_of_rooms,
-            "offset": offset,
         }
     )
-    return url
+
+
+def create_search_page_url(search_query: str, offset: int = 0) -> str:
+    """creates url of a single hotel search page of booking.com"""
+    return f"https://www.booking.com/searchresults.html?{search_query}&offset={offset}"
 
 
 def parse_search_total_results(result: ScrapeApiResponse) -> int:
     """parse total number of results from search page HTML"""
     # parse total amount of pages from heading1 text:
     # e.g. "London: 1,232 properties found"
-    total_results = int(result.selector.css("h1").re("([\d,]+) properties found")[0].replace(",", ""))
+    # the phrase only appears in the heading, so the raw HTML is searched
+    # directly instead of building a selector for this single value
+    total_results = int(_RE_PROPS_FOUND.search(result.content).group(1).replace(",", ""))
     if total_results > 50:
         return 50 # limits number of hotels per city
     return total_results
@@ -110,48 +181,80 @@ class HotelPreview(TypedDict):
     image: str
 
 
+_PROPERTY_CARD = etree.XPath('//div[@data-testid="property-card"]')
+_TITLE_LINK = etree.XPath('string(.//h3/a[@data-testid="title-link"]/@href)', smart_strings=False)
+_NAME = etree.XPath('string(.//h3/a[@data-testid="title-link"]/div/text())', smart_strings=False)
+_LOCATION = etree.XPath('string(.//span[@data-testid="address"]/text())', smart_strings=False)
+_SCORE = etree.XPath('string(.//div[@data-testid="review-score"]/div/text())', smart_strings=False)
+_REVIEW_COUNT = etree.XPath('string(.//div[@data-testid="review-score"]/div[2]/div[2]/text())', smart_strings=False)
+_STARS = etree.XPath('count(.//div[@data-testid="rating-stars"]/span)')
+_IMAGE = etree.XPath('.//img[@data-testid="image"]/@src', smart_strings=False)
+
+
+def _parse_card(
+    hotel_box,
+    _title_link=_TITLE_LINK,
+    _name=_NAME,
+    _location=_LOCATION,
+    _score=_SCORE,
+    _review_count=_REVIEW_COUNT,
+    _stars=_STARS,
+    _image=_IMAGE,
+):
+    """parse a single property card into its (url, preview) pair"""
+    # search pages always have the same six fields per card, so this is written
+    # out field by field with the compiled selectors bound as fast locals
+    images = _image(hotel_box)
+    return _title_link(hotel_box).split("?")[0], {
+        "name": _name(hotel_box),
+        "location": _location(hotel_box),
+        "score": _score(hotel_box),
+        "review_count": _review_count(hotel_box),
+        "stars": int(_stars(hotel_box)),
+        "image": images[0] if images else None,
+    }
+
+
+def parse_cards(html: str) -> Dict[str, HotelPreview]:
+    """parse hotel preview cards from raw search page HTML"""
+    return dict(map(_parse_card, _PROPERTY_CARD(_parse_html(html))))
+
+
 def parse_search_page(result: ScrapeApiResponse) -> Dict[str, HotelPreview]:
     """parse hotel preview data from search page HTML"""
-    hotel_previews = {}
-    for hotel_box in result.selector.xpath('//div[@data-testid="property-card"]'):
-        url = hotel_box.xpath('.//h3/a[@data-testid="title-link"]/@href').get("").split("?")[0]
-        hotel_previews[url] = {
-            "name": hotel_box.xpath('.//h3/a[@data-testid="title-link"]/div/text()').get(""),
-            "location": hotel_box.xpath('.//span[@data-testid="address"]/text()').get(""),
-            "score": hotel_box.xpath('.//div[@data-testid="review-score"]/div/text()').get(""),
-            "review_count": hotel_box.xpath('.//div[@data-testid="review-score"]/div[2]/div[2]/text()').get(""),
-            "stars": len(hotel_box.xpath('.//div[@data-testid="rating-stars"]/span').getall()),
-            "image": hotel_box.xpath('.//img[@data-testid="image"]/@src').get(),
-        }
-    return hotel_previews
+    return parse_cards(result.content)
 
 
 async def scrape_search(
     query,
-    session: ScrapflyClient,
+    session: LimitedSession,
     checkin: str = "",
     checkout: str = "",
     number_of_rooms=1,
 ):
     """scrape all hotel previews from a given search query"""
-    first_page_url = create_search_page_url(
+    # the query is the same for every page, so it is encoded once and only the offset changes
+    search_query = create_search_query(
         query=query, checkin=checkin, checkout=checkout, number_of_rooms=number_of_rooms
     )
-    first_page = await session.async_scrape(ScrapeConfig(url=first_page_url, country="US"))
+    first_page = await session.async_scrape(ScrapeConfig(url=create_search_page_url(search_query), country="US"))
     total_results = parse_search_total_results(first_page)
-    hotel_previews = parse_search_page(first_page)
-    other_page_urls = [
-        create_search_page_url(
-            query=query,
-            checkin=checkin,
-            checkout=checkout,
-            number_of_rooms=number_of_rooms,
-            offset=offset,
-        )
-        for offset in range(25, total_results, 25)
-    ]
-    async for result in session.concurrent_scrape([ScrapeConfig(url, country="US") for url in other_page_urls]):
-        hotel_previews.update(parse_search_page(result))
+    loop = asyncio.get_running_loop()
+    parsing = [loop.run_in_executor(_PARSE_POOL, parse_cards, first_page.content)]
+    other_page_urls = [create_search_page_url(search_query, offset) for offset in range(25, total_results, 25)]
+    try:
+        async for result in session.concurrent_scrape([ScrapeConfig(url, country="US") for url in other_page_urls]):
+            parsing.append(loop.run_in_executor(_PARSE_POOL, parse_cards, result.content))
+        parsed_pages = await asyncio.gather(*parsing)
+    except BaseException:
+        # drop the pages still waiting to be parsed instead of leaving them unobserved
+        for future in parsing:
+            future.cancel()
+        await asyncio.gather(*parsing, return_exceptions=True)
+        raise
+    hotel_previews = {}
+    for previews in parsed_pages:
+        hotel_previews.update(previews)
     return hotel_previews
 
 
@@ -169,84 +272,127 @@ class Hotel(TypedDict):
     price: dict
 
 
-def parse_hotel(result: ScrapeApiResponse) -> Hotel:
-    """parse hotel page for hotel information (no pricing or reviews)"""
-    css = lambda selector, sep="": sep.join(result.selector.css(selector).getall()).strip()
-    css_first = lambda selector: result.selector.css(selector).get("")
-    lat, lng = css_first(".show_map_hp_link::attr(data-atlas-latlng)").split(",")
+_LATLNG = _compile_css(".show_map_hp_link::attr(data-atlas-latlng)")
+_FEATURE_GROUP = _compile_css(".hotel-facilities-group")
+_FEATURE_TYPE = _compile_css(".bui-title__text::text")
+_FEATURE_ITEM = _compile_css(".bui-list__description::text")
+_HOTEL_TITLE = _compile_css("h2.pp-header__title::text")
+_HOTEL_DESCRIPTION = _compile_css("div#property_description_content ::text")
+_HOTEL_ADDRESS = _compile_css(".hp_address_subtitle::text")
+_TOKEN_SCRIPT = etree.XPath('string(//script[contains(., "b_hotel_id")])', smart_strings=False)
+
+
+def parse_hotel(result: ScrapeApiResponse) -> Tuple[Hotel, str, str, str]:
+    """parse hotel page for hotel information (no pricing or reviews)
+    and the csrf token, aid and sid needed for background requests"""
+    root = _parse_html(result.content)
+    lat, lng = _first(_LATLNG, root).split(",")
     features = defaultdict(list)
     #title_class_name = re.findall(r"[A-Za-z0-9]+ pp-header__title", result.content)[0]
     #print(title_class_name)
-    for feat_box in result.selector.css(".hotel-facilities-group"):
-        type_ = "".join(feat_box.css(".bui-title__text::text").getall()).strip()
-        features[type_].extend([f.strip() for f in feat_box.css(".bui-list__description::text").getall() if f.strip()])
+    for feat_box in _FEATURE_GROUP(root):
+        type_ = "".join(_FEATURE_TYPE(feat_box)).strip()
+        features[type_].extend([f.strip() for f in _FEATURE_ITEM(feat_box) if f.strip()])
     data = {
-        "title": css(f"h2.pp-header__title::text"),
-        "description": css("div#property_description_content ::text", "\n"),
-        "address": css(".hp_address_subtitle::text"),
+        "title": "".join(_HOTEL_TITLE(root)).strip(),
+        "description": "\n".join(_HOTEL_DESCRIPTION(root)).strip(),
+        "address": "".join(_HOTEL_ADDRESS(root)).strip(),
         "lat": lat,
         "lng": lng,
         "features": dict(features),
-        "id": re.findall(r"b_hotel_id:\s*'(.+?)'", result.content)[0],
     }
-    return data
-
-
-async def scrape_hotels(urls: List[str], session: ScrapflyClient, price_start_dt: str, price_n_days=30) -> List[Hotel]:
+    # the tokens live in one inline script, so only that script is searched
+    # instead of the whole page; fall back to the page if they are spread out
+    tokens = parse_hotel_tokens(_TOKEN_SCRIPT(root))
+    if len(tokens) < 4:
+        tokens = parse_hotel_tokens(result.content)
+    data["id"] = tokens["hotel_id"]
+    return data, tokens["csrf_token"], tokens["aid"], tokens["sid"]
+
+
+def parse_hotel_tokens(html: str) -> Dict[str, str]:
+    """parse hotel id and the secret tokens needed for background requests from page HTML or script text"""
+    # single pass, stopping as soon as all four values are seen
+    tokens = {}
+    for match in _RE_TOKENS.finditer(html):
+        tokens.setdefault(match.group(1), match.group(2))
+        if len(tokens) == 4:
+            break
+    return tokens
+
+
+async def scrape_hotels(
+    urls: List[str],
+    session: LimitedSession,
+    price_start_dt: str,
+    price_n_days=30,
+    hotel_slots: Optional[asyncio.Semaphore] = None,
+) -> List[Hotel]:
     """scrape list of hotel urls with pricing details"""
+    # ScrapFly fails to keep track of its scraping sessions when more than 5 hotels
+    # are scraped at once (results come back empty), so every hotel scrape takes
+    # a slot; run() shares one set of slots between all of its cities
+    if hotel_slots is None:
+        hotel_slots = asyncio.Semaphore(5)
 
     async def scrape_hotel(url: str) -> Hotel:
-        url += "?" + urlencode({"cur_currency": "usd"})
-        _scrapfly_session = ""
-        result_hotel = await session.async_scrape(ScrapeConfig(url, country="US"))
-        hotel = parse_hotel(result_hotel)
-        hotel["url"] = str(result_hotel.context["url"])
-
-        # for background requests we need to find some secret tokens:
-        csrf_token = re.findall(r"b_csrf_token:\s*'(.+?)'", result_hotel.content)[0]
-        aid = re.findall(r"b_aid:\s*'(.+?)'", result_hotel.content)[0]
-        sid = re.findall(r"b_sid:\s*'(.+?)'", result_hotel.content)[0]
-        price_calendar_form = {
-            "name": "hotel.availability_calendar",
-            "result_format": "price_histogram",
-            "hotel_id": hotel["id"],
-            "search_config": json.dumps(
-                {
-                    # we can adjust pricing configuration here but this is the default
-                    "b_adults_total": 2,
-                    "b_nr_rooms_needed": 1,
-                    "b_children_total": 0,
-                    "b_children_ages_total": [],
-                    "b_is_group_search": 0,
-                    "b_pets_total": 0,
-                    "b_rooms": [{"b_adults": 2, "b_room_order": 1}],
-                }
-            ),
-            "checkin": price_start_dt,
-            "n_days": price_n_days,
-            "respect_min_los_restriction": 1,
-            "los": 1,
-        }
-        result_price = await session.async_scrape(
-            ScrapeConfig(
-                url="https://www.booking.com/fragment.json?cur_currency=usd",
-                method="POST",
-                data=price_calendar_form,
-                # we need to use cookies we received from hotel scrape to access background requests like this one
-                cookies=CaseInsensitiveDict({v['name']: v['value'] for v in result_hotel.scrape_result['cookies']}),
-                headers={
-                    "X-Booking-CSRF": csrf_token,
-                    "X-Requested-With": "XMLHttpRequest",
-                    "X-Booking-AID": aid,
-                    "X-Booking-Session-Id": sid,
-                },
-                country="US",
+        async with hotel_slots:
+            url += "?" + urlencode({"cur_currency": "usd"})
+            _scrapfly_session = ""
+            result_hotel = await session.async_scrape(ScrapeConfig(url, country="US"))
+            # for background requests we need to find some secret tokens:
+            hotel, csrf_token, aid, sid = parse_hotel(result_hotel)
+            hotel["url"] = str(result_hotel.context["url"])
+            price_calendar_form = {
+                "name": "hotel.availability_calendar",
+                "result_format": "price_histogram",
+                "hotel_id": hotel["id"],
+                "search_config": orjson.dumps(
+                    {
+                        # we can adjust pricing configuration here but this is the default
+                        "b_adults_total": 2,
+                        "b_nr_rooms_needed": 1,
+                        "b_children_total": 0,
+                        "b_children_ages_total": [],
+                        "b_is_group_search": 0,
+                        "b_pets_total": 0,
+                        "b_rooms": [{"b_adults": 2, "b_room_order": 1}],
+                    }
+                ).decode(),
+                "checkin": price_start_dt,
+                "n_days": price_n_days,
+                "respect_min_los_restriction": 1,
+                "los": 1,
+            }
+            result_price = await session.async_scrape(
+                ScrapeConfig(
+                    url="https://www.booking.com/fragment.json?cur_currency=usd",
+                    method="POST",
+                    data=price_calendar_form,
+                    # we need to use cookies we received from hotel scrape to access background requests like this one
+                    cookies=CaseInsensitiveDict({v['name']: v['value'] for v in result_hotel.scrape_result['cookies']}),
+                    headers={
+                        "X-Booking-CSRF": csrf_token,
+                        "X-Requested-With": "XMLHttpRequest",
+                        "X-Booking-AID": aid,
+                        "X-Booking-Session-Id": sid,
+                    },
+                    country="US",
+                )
             )
-        )
-        hotel["price"] = json.loads(result_price.content)["data"]
-        return hotel
-
-    hotels = await asyncio.gather(*[scrape_hotel(url) for url in urls])
+            hotel["price"] = orjson.loads(result_price.content)["data"]
+            return hotel
+
+    tasks = [asyncio.ensure_future(scrape_hotel(url)) for url in urls]
+    try:
+        hotels = await asyncio.gather(*tasks)
+    except BaseException:
+        # one failed hotel fails the whole list, so the hotels still waiting or
+        # running are stopped instead of spending requests on a discarded result
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
     return hotels
 
 
@@ -263,164 +409,204 @@ class Review(TypedDict):
     lang: str
 
 
-def parse_reviews(result: ScrapeApiResponse) -> List[Review]:
-    """parse review page for review data"""
+_REVIEW_BOX = _compile_css(".review_list_new_item_block")
+_REVIEW_ID = etree.XPath("@data-review-url", smart_strings=False)
+_REVIEW_SCORE = _compile_css(".bui-review-score__badge::text")
+_REVIEW_TITLE = _compile_css(".c-review-block__title::text")
+_REVIEW_DATE = _compile_css(".c-review-block__date::text")
+_REVIEW_USER_NAME = _compile_css(".bui-avatar-block__title::text")
+_REVIEW_USER_COUNTRY = _compile_css(".bui-avatar-block__subtitle::text")
+_REVIEW_TEXT = _compile_css(".c-review__body ::text")
+_REVIEW_LANG = _compile_css(".c-review__body::attr(lang)")
+_REVIEW_PAGE_NUMBER = _compile_css(".bui-pagination__link::attr(data-page-number)")
+
+
+def _parse_review_boxes(root: etree._Element) -> List[Review]:
+    """parse review data from an already parsed review page"""
     parsed = []
-    for review_box in result.selector.css(".review_list_new_item_block"):
-        get_css = lambda css: review_box.css(css).get("").strip()
+    for review_box in _REVIEW_BOX(root):
         parsed.append(
             {
-                "id": review_box.xpath("@data-review-url").get(),
-                "score": get_css(".bui-review-score__badge::text"),
-                "title": get_css(".c-review-block__title::text"),
-                "date": get_css(".c-review-block__date::text"),
-                "user_name": get_css(".bui-avatar-block__title::text"),
-                "user_country": get_css(".bui-avatar-block__subtitle::text"),
-                "text": "".join(review_box.css(".c-review__body ::text").getall()),
-                "lang": review_box.css(".c-review__body::attr(lang)").get(),
+                "id": _first(_REVIEW_ID, review_box, None),
+                "score": _first(_REVIEW_SCORE, review_box).strip(),
+                "title": _first(_REVIEW_TITLE, review_box).strip(),
+                "date": _first(_REVIEW_DATE, review_box).strip(),
+                "user_name": _first(_REVIEW_USER_NAME, review_box).strip(),
+                "user_country": _first(_REVIEW_USER_COUNTRY, review_box).strip(),
+                "text": "".join(_REVIEW_TEXT(review_box)),
+                "lang": _first(_REVIEW_LANG, review_box, None),
             }
         )
     return parsed
 
 
-async def scrape_reviews(hotel_id: str, session: ScrapflyClient) -> List[dict]:
+def parse_review_list(html: str) -> List[Review]:
+    """parse review data from raw review page HTML"""
+    return _parse_review_boxes(_parse_html(html))
+
+
+def parse_first_review_page(html: str) -> Tuple[List[Review], int]:
+    """parse review data and the total number of review pages from raw first review page HTML"""
+    root = _parse_html(html)
+    total_pages = max((int(page) for page in _REVIEW_PAGE_NUMBER(root)), default=1)
+    return _parse_review_boxes(root), total_pages
+
+
+def parse_reviews(result: ScrapeApiResponse) -> List[Review]:
+    """parse review page for review data"""
+    return parse_review_list(result.content)
+
+
+async def scrape_reviews(hotel_id: str, session: LimitedSession, speculative_pages: int = 4) -> List[dict]:
     """scrape all reviews of a hotel"""
+    speculative_pages = max(speculative_pages, 1) # page 1 is always requested first
 
-    def create_review_url(page, page_size=25):  # 25 is largest possible page size for this endpoint
-        """create url for specific page of hotel review pagination"""
-        return "https://www.booking.com/reviewlist.html?" + urlencode(
-            {
-                "type": "total",
-                "lang": "en-us",
-                "sort": "f_recent_desc",
-                "cc1": "gb",
-                "dist": 1,
-                "pagename": hotel_id,
-                "rows": page_size,
-                "offset": page * page_size,
-            }
-        )
+    page_size = 25  # 25 is largest possible page size for this endpoint
+    review_query = urlencode(
+        {
+            "type": "total",
+            "lang": "en-us",
+            "sort": "f_recent_desc",
+            "cc1": "gb",
+            "dist": 1,
+            "pagename": hotel_id,
+            "rows": page_size,
+        }
+    )
 
-    first_page = await session.async_scrape(ScrapeConfig(url=create_review_url(1), country="US"))
-    total_pages = first_page.selector.css(".bui-pagination__link::attr(data-page-number)").getall()
-    total_pages = max(int(page) for page in total_pages)
-    other_page_urls = [create_review_url(page) for page in range(2, total_pages + 1)]
-    reviews = parse_reviews(first_page)
-    async for result in session.concurrent_scrape([ScrapeConfig(url, country="US") for url in other_page_urls]):
-        reviews.extend(parse_reviews(result))
+    def create_review_url(page):
+        """create url for specific page of hotel review pagination"""
+        offset = (page - 1) * page_size # pages are numbered from 1
+        return f"https://www.booking.com/reviewlist.html?{review_query}&offset={offset}"
+
+    loop = asyncio.get_running_loop()
+
+    async def scrape_page(page: int) -> List[Review]:
+        result = await session.async_scrape(ScrapeConfig(url=create_review_url(page), country="US"))
+        return await loop.run_in_executor(_PARSE_POOL, parse_review_list, result.content)
+
+    # the first few pages are requested together with page 1, before it tells
+    # how many pages there are, so hotels with few reviews take one round trip
+    first_page_task = asyncio.ensure_future(session.async_scrape(ScrapeConfig(url=create_review_url(1), country="US")))
+    pages = {page: asyncio.ensure_future(scrape_page(page)) for page in range(2, speculative_pages + 1)}
+    try:
+        first_page = await first_page_task
+        first_reviews, total_pages = await loop.run_in_executor(_PARSE_POOL, parse_first_review_page, first_page.content)
+        dropped = [pages.pop(page) for page in [page for page in pages if page > total_pages]]
+        for task in dropped:
+            task.cancel()
+        await asyncio.gather(*dropped, return_exceptions=True)
+
+        # results of the remaining pages come back in any order, so they are keyed by page
+        other_page_urls = {create_review_url(page): page for page in range(speculative_pages + 1, total_pages + 1)}
+        async for result in session.concurrent_scrape([ScrapeConfig(url, country="US") for url in other_page_urls]):
+            page = other_page_urls[result.scrape_config.url]
+            pages[page] = loop.run_in_executor(_PARSE_POOL, parse_review_list, result.content)
+        reviews = first_reviews
+        for page in sorted(pages):
+            reviews.extend(await pages[page])
+    except BaseException:
+        # stop the speculative and remaining pages instead of leaving them running unobserved
+        first_page_task.cancel()
+        for task in pages.values():
+            task.cancel()
+        await asyncio.gather(first_page_task, *pages.values(), return_exceptions=True)
+        raise
     return reviews
 
 
 # populates hotel listings for a given search
-async def fetch_listings(query_str: str):
-    hotel_listings = await scrape_search(query_str, session)
+async def fetch_listings(query_str: str, _session: LimitedSession):
+    hotel_listings = await scrape_search(query_str, _session)
     return hotel_listings
 
 
 # Collects information about hotel listings found with a given query.
-# Since ScrapFly has a bug where it cannot keep track of scraping sessions
-# within the `scrape_hotels()` method. This process has to be done manually,
-# and as seen below the limit is 5 scraping instances at one time. If I try
-# to scrape with more than 5 instances at one given time with this method
-# the scraping returns empty objects and crashes the program.
-async def drill_listings(_hotel_listings):
-
-    # splits urls in parts of 5 and inserts them in a meta list
-    def create_nested_list(urls_list):
-        chunk_size = 5
-        return [urls_list[i:i+chunk_size] for i in range(0, len(urls_list), chunk_size)]
-
-    # scrapes hotels, but takes only five at a time
-    async def drill_next_five(_urls_dict):
-        result_hotels = await scrape_hotels(
-        urls=_urls_dict,
-        session=session,
+# ScrapFly can only handle 5 hotel scraping instances at one time, any more
+# returns empty objects and crashes the program. `scrape_hotels()` limits this
+# per hotel with `hotel_slots`, so all listings are handed over at once and the
+# next hotel starts as soon as one of the five finishes.
+async def drill_listings(_hotel_listings, _session: LimitedSession, hotel_slots: asyncio.Semaphore):
+    return await scrape_hotels(
+        urls=list(_hotel_listings),
+        session=_session,
         price_start_dt=datetime.date.today().strftime('%Y-%m-%d'), # start date: checkin today
         price_n_days=7, # how many nights to stay
-        )
-        return result_hotels
-
-    # extract URLs
-    urls_list = []
-    for url, data in _hotel_listings.items():
-        urls_list.append(url)
-
-    # gathers data
-    chunked_lists = create_nested_list(urls_list)
-    drill_results = []
-    for nested_list in chunked_lists:
-        drill_results.append(await drill_next_five(nested_list))
-
-    # reorganizes result into one list instead of sublists
-    result = []
-    for drill_result in drill_results:
-        for listing in drill_result:
-            result.append(listing)
-
-    return result
+        hotel_slots=hotel_slots,
+    )
 
 
 def read_worldcities():
     # reading CSV file
-    data = read_csv("./data/filtered_worldcities.csv")
+    data = pd.read_csv("./data/filtered_worldcities.csv", usecols=["city_ascii", "country"])
     global total_cities_count
     global total_countries_count
     total_cities_count = data.shape[0]
-    total_countries_count = data.country.nunique()
     # converting column data to list
     #cities = data['city'].tolist()
     # city_ascii = data['city_ascii'].tolist()
     # lat = data['lat'].tolist()
     # lng = data['lng'].tolist()
     #countries = data['country'].tolist()
-    res_dict = {}
-    # creates key -> value structure with {country: [cities]}
-    for index in data.index:
-        #print(data['city_ascii'][index], data['country'][index])
-        if (data['country'][index] in res_dict.keys()): # if country key already exists in dict and has sublist
-            res_dict[data['country'][index]].append(data['city_ascii'][index]) # append city to list
-        else:
-            res_dict[data['country'][index]] = [data['city_ascii'][index]] # if not then create new list and insert the city
-
+    # creates key -> value structure with {country: [cities]}, keeping the csv order
+    res_dict = data.groupby("country", sort=False)["city_ascii"].apply(list).to_dict()
+    total_countries_count = len(res_dict) # one key per country, no second pass over the column
     return res_dict
 
 
 # first search to find hotel listings and their urls
 # TODO: add memory function to remember the last scraped city so the scraper
 #       is able to continue from the last added city.
-async def run():
-    global current_cities_count
-    global current_city
-    global current_country
-    global listings_count
-    global current_countries_count
+async def run(city_concurrency: int = 8):
     start_status()
-    filename = f"./data/results/result_{datetime.datetime.now()}.json"
+    filename = f"./data/results/result_{datetime.datetime.now()}.mpk" # convert with mpk_to_json.py
     country_cities_dict = read_worldcities()
-    final_result = {}
-    for country in country_cities_dict.keys():
-        current_country = country
-        current_countries_count += 1
-        final_result[country] = {} # creates empty dict to add items to
-        for city in country_cities_dict[country]:
+    final_result = {country: {} for country in country_cities_dict} # creates empty dicts to add items to
+    started_countries = set()
+    packer = msgpack.Packer()
+    # cities only keep the client's request slots busy, the requests of all
+    # cities together never go over its max_concurrency
+    limited_session = LimitedSession(session)
+    city_slots = asyncio.Semaphore(city_concurrency) # limits how many cities are scraped at once
+    hotel_slots = asyncio.Semaphore(5) # limits hotel scrapes across all cities, see drill_listings()
+
+    async def process_city(country: str, city: str):
+        global current_cities_count
+        global current_city
+        global current_country
+        global listings_count
+        global current_countries_count
+        async with city_slots:
+            current_country = country
             current_city = city
-            current_cities_count+=1
+            current_cities_count += 1
+            if country not in started_countries:
+                started_countries.add(country)
+                current_countries_count += 1
             try:
-                hotel_listings = await fetch_listings(city) # starts fetching hotel listings for current city
-                result_hotels = await drill_listings(hotel_listings) # extracts information about listings
-                final_result[country][city] = [] # creates empty list to append items to
-                for hotel_data in result_hotels: # appends data from current city to the final result
-                    final_result[country][city].append(hotel_data)
-                    with open(filename, "w") as f:
-                        json.dump(final_result, f, indent=4)
-                    listings_count += 1
+                hotel_listings = await fetch_listings(city, limited_session) # starts fetching hotel listings for current city
+                result_hotels = await drill_listings(hotel_listings, limited_session, hotel_slots) # extracts information about listings
+                final_result[country][city] = result_hotels # appends data from current city to the final result
+                for hotel_data in result_hotels: # saves progress as one msgpack record per hotel
+                    checkpoint.write(packer.pack({"country": country, "city": city, "hotel": hotel_data}))
+                checkpoint.flush() # keeps the progress file current if the run is killed
+                listings_count += len(result_hotels)
                 #print(f"fetched {i} listings from {city} in {country}")
             except Exception as e:
                 pass
                 #print(f"no hotels found in {city} in {country}")
                 #traceback.print_exc()
-    with open("./data/results/final_result.json", "w") as f:
-            json.dump(final_result, f, indent=4)
+
+    worklist = [(country, city) for country, cities in country_cities_dict.items() for city in cities]
+    with open(filename, "ab", buffering=1 << 16) as checkpoint:
+        await asyncio.gather(*(process_city(country, city) for country, city in worklist))
+    # cities finish in any order, so the result is put back in csv order
+    final_result = {
+        country: {city: final_result[country][city] for city in cities if city in final_result[country]}
+        for country, cities in country_cities_dict.items()
+    }
+    with open("./data/results/final_result.json", "wb") as f:
+            f.write(orjson.dumps(final_result, option=orjson.OPT_INDENT_2))
     global status_active
     status_active = False
     print()
@@ -433,4 +619,8 @@ if __name__ == "__main__":
     # loads environment variables and initializes ScrapFly session
     load_dotenv()
     with ScrapflyClient(key=os.getenv("SCRAPFLY_API_KEY"), max_concurrency=5) as session:
+        # the client sends every request through one keep-alive requests session, and
+        # run() keeps at most max_concurrency of them in flight, so the pool keeps one
+        # reusable connection per request slot, whatever max_concurrency is set to
+        session.http_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=session.max_concurrency))
         asyncio.run(run()) # initializes scraping
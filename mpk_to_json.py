@@ -0,0 +1,25 @@
+import os
+import sys
+import msgpack
+import orjson
+
+
+# Converts a progress file written by `hotel_fetch.py` (one msgpack record per
+# hotel) into the same {country: {city: [hotels]}} json structure as
+# final_result.json. Useful when a run was stopped before it finished.
+def convert(mpk_filename: str, json_filename: str):
+    result = {}
+    with open(mpk_filename, "rb") as f:
+        for record in msgpack.Unpacker(f):
+            result.setdefault(record["country"], {}).setdefault(record["city"], []).append(record["hotel"])
+    with open(json_filename, "wb") as f:
+        f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python mpk_to_json.py <result.mpk> [output.json]")
+        sys.exit(1)
+    mpk_filename = sys.argv[1]
+    json_filename = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(mpk_filename)[0] + ".json"
+    convert(mpk_filename, json_filename)